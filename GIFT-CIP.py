@@ -1,9 +1,12 @@
-from typing import Optional, Tuple, Union, Dict
+from typing import Callable, Iterable, Optional, Tuple, Union, Dict, List
+import copy
 import math
+import types
 import torch
 import torch.nn as nn
 from torch import Tensor
 from torch.nn import functional as F
+from torch.nn.utils.fusion import fuse_conv_bn_eval
 from transformer import TransformerEncoder
 from GIFT_config import get_config
 
@@ -13,13 +16,22 @@ def make_divisible(
     v: Union[float, int],
     divisor: Optional[int] = 8,
     min_value: Optional[Union[float, int]] = None,
-) -> Union[float, int]:
+) -> int:
     if min_value is None:
         min_value = divisor
     new_v = max(min_value, int(v + divisor / 2) // divisor * divisor)
     if new_v < 0.9 * v:
         new_v += divisor
-    return new_v
+    return int(new_v)
+
+
+@torch.no_grad()
+def fuse_linear(first: nn.Linear, second: nn.Linear) -> nn.Linear:
+    # second(first(x)) with no activation in between is a single affine map
+    fused = nn.Linear(first.in_features, second.out_features, device=first.weight.device, dtype=first.weight.dtype)
+    fused.weight.copy_(second.weight @ first.weight)
+    fused.bias.copy_(second.bias + second.weight @ first.bias)
+    return fused
 
 
 class ConvLayer(nn.Module):
@@ -34,6 +46,7 @@ class ConvLayer(nn.Module):
         bias: Optional[bool] = False,
         use_norm: Optional[bool] = True,
         use_act: Optional[bool] = True,
+        inplace_act: Optional[bool] = False,
     ) -> None:
         super().__init__()
 
@@ -70,7 +83,7 @@ class ConvLayer(nn.Module):
             block.add_module(name="norm", module=norm_layer)
 
         if use_act:
-            act_layer = nn.SiLU()
+            act_layer = nn.SiLU(inplace=inplace_act)
             block.add_module(name="act", module=act_layer)
 
         self.block = block
@@ -88,9 +101,12 @@ class InvertedResidual(nn.Module):
         stride: int,
         expand_ratio: Union[int, float],
         skip_connection: Optional[bool] = True,
+        groups: Optional[int] = 1,
     ) -> None:
         assert stride in [1, 2]
-        hidden_dim = make_divisible(int(round(in_channels * expand_ratio)), 8)
+        assert in_channels % groups == 0 and out_channels % groups == 0
+        # groups > 1 packs several independent blocks along the channel dim
+        hidden_dim = make_divisible(int(round(in_channels // groups * expand_ratio)), 8) * groups
 
         super().__init__()
 
@@ -101,7 +117,8 @@ class InvertedResidual(nn.Module):
                 module=ConvLayer(
                     in_channels=in_channels,
                     out_channels=hidden_dim,
-                    kernel_size=1
+                    kernel_size=1,
+                    groups=groups
                 ),
             )
 
@@ -122,6 +139,7 @@ class InvertedResidual(nn.Module):
                 in_channels=hidden_dim,
                 out_channels=out_channels,
                 kernel_size=1,
+                groups=groups,
                 use_act=False,
                 use_norm=True,
             ),
@@ -130,6 +148,7 @@ class InvertedResidual(nn.Module):
         self.block = block
         self.in_channels = in_channels
         self.out_channels = out_channels
+        self.hidden_dim = hidden_dim
         self.exp = expand_ratio
         self.stride = stride
         self.use_res_connect = (
@@ -138,7 +157,10 @@ class InvertedResidual(nn.Module):
 
     def forward(self, x: Tensor, *args, **kwargs) -> Tensor:
         if self.use_res_connect:
-            return x + self.block(x)
+            if torch.is_grad_enabled():
+                return x + self.block(x)
+            # inference: accumulate the residual into the freshly allocated block output
+            return self.block(x).add_(x)
         else:
             return self.block(x)
 
@@ -163,11 +185,13 @@ class MobileViTBlock(nn.Module):
     ) -> None:
         super().__init__()
 
+        # output only feeds conv_1x1_in, so the activation can run in place
         conv_3x3_in = ConvLayer(
             in_channels=in_channels,
             out_channels=in_channels,
             kernel_size=conv_ksize,
-            stride=1
+            stride=1,
+            inplace_act=True
         )
         conv_1x1_in = ConvLayer(
             in_channels=in_channels,
@@ -184,12 +208,26 @@ class MobileViTBlock(nn.Module):
             kernel_size=1,
             stride=1
         )
+        # conv over cat(res, fm) split into one conv per input, summed before the shared norm + act
+        conv_3x3_out_res = ConvLayer(
+            in_channels=in_channels,
+            out_channels=in_channels,
+            kernel_size=conv_ksize,
+            stride=1,
+            use_norm=False,
+            use_act=False
+        )
         conv_3x3_out = ConvLayer(
-            in_channels=2 * in_channels,
+            in_channels=in_channels,
             out_channels=in_channels,
             kernel_size=conv_ksize,
-            stride=1
+            stride=1,
+            use_norm=False,
+            use_act=False
         )
+        fusion_norm_act = nn.Sequential()
+        fusion_norm_act.add_module(name="norm", module=nn.BatchNorm2d(num_features=in_channels, momentum=0.1))
+        fusion_norm_act.add_module(name="act", module=nn.SiLU())
 
         self.local_rep = nn.Sequential()
         self.local_rep.add_module(name="conv_3x3", module=conv_3x3_in)
@@ -198,7 +236,7 @@ class MobileViTBlock(nn.Module):
         assert transformer_dim % head_dim == 0
         num_heads = transformer_dim // head_dim
 
-        global_rep = [
+        self.global_rep = nn.ModuleList([
             TransformerEncoder(
                 embed_dim=transformer_dim,
                 ffn_latent_dim=ffn_dim,
@@ -208,12 +246,13 @@ class MobileViTBlock(nn.Module):
                 ffn_dropout=ffn_dropout
             )
             for _ in range(n_transformer_blocks)
-        ]
-        global_rep.append(nn.LayerNorm(transformer_dim))
-        self.global_rep = nn.Sequential(*global_rep)
+        ])
+        self.global_ln = nn.LayerNorm(transformer_dim)
 
         self.conv_proj = conv_1x1_out
         self.fusion = conv_3x3_out
+        self.fusion_res = conv_3x3_out_res
+        self.fusion_norm_act = fusion_norm_act
 
         self.patch_h = patch_h
         self.patch_w = patch_w
@@ -248,16 +287,12 @@ class MobileViTBlock(nn.Module):
         num_patch_h = new_h // patch_h  # n_h
         num_patches = num_patch_h * num_patch_w  # N
 
-        # [B, C, H, W] -> [B * C * n_h, p_h, n_w, p_w]
-        x = x.reshape(batch_size * in_channels * num_patch_h, patch_h, num_patch_w, patch_w)
-        # [B * C * n_h, p_h, n_w, p_w] -> [B * C * n_h, n_w, p_h, p_w]
-        x = x.transpose(1, 2)
-        # [B * C * n_h, n_w, p_h, p_w] -> [B, C, N, P] where P = p_h * p_w and N = n_h * n_w
-        x = x.reshape(batch_size, in_channels, num_patches, patch_area)
-        # [B, C, N, P] -> [B, P, N, C]
-        x = x.transpose(1, 3)
-        # [B, P, N, C] -> [BP, N, C]
-        x = x.reshape(batch_size * patch_area, num_patches, -1)
+        # [B, C, H, W] -> [B, H, W, C] (a free view for channels_last inputs) -> [B, n_h, p_h, n_w, p_w, C]
+        x = x.permute(0, 2, 3, 1).reshape(batch_size, num_patch_h, patch_h, num_patch_w, patch_w, in_channels)
+        # [B, n_h, p_h, n_w, p_w, C] -> [B, p_h, p_w, n_h, n_w, C]
+        x = x.permute(0, 2, 4, 1, 3, 5)
+        # [B, p_h, p_w, n_h, n_w, C] -> [BP, N, C] where P = p_h * p_w and N = n_h * n_w (single copy)
+        x = x.reshape(batch_size * patch_area, num_patches, in_channels)
 
         info_dict = {
             "orig_size": (orig_h, orig_w),
@@ -275,23 +310,19 @@ class MobileViTBlock(nn.Module):
         assert n_dim == 3, "Tensor should be of shape BPxNxC. Got: {}".format(
             x.shape
         )
-        # [BP, N, C] --> [B, P, N, C]
-        x = x.contiguous().view(
-            info_dict["batch_size"], self.patch_area, info_dict["total_patches"], -1
-        )
-
-        batch_size, pixels, num_patches, channels = x.size()
+        batch_size = info_dict["batch_size"]
+        channels = x.shape[-1]
         num_patch_h = info_dict["num_patches_h"]
         num_patch_w = info_dict["num_patches_w"]
 
-        # [B, P, N, C] -> [B, C, N, P]
-        x = x.transpose(1, 3)
-        # [B, C, N, P] -> [B*C*n_h, n_w, p_h, p_w]
-        x = x.reshape(batch_size * channels * num_patch_h, num_patch_w, self.patch_h, self.patch_w)
-        # [B*C*n_h, n_w, p_h, p_w] -> [B*C*n_h, p_h, n_w, p_w]
-        x = x.transpose(1, 2)
-        # [B*C*n_h, p_h, n_w, p_w] -> [B, C, H, W]
-        x = x.reshape(batch_size, channels, num_patch_h * self.patch_h, num_patch_w * self.patch_w)
+        # [BP, N, C] -> [B, p_h, p_w, n_h, n_w, C]
+        x = x.reshape(batch_size, self.patch_h, self.patch_w, num_patch_h, num_patch_w, channels)
+        # [B, p_h, p_w, n_h, n_w, C] -> [B, n_h, p_h, n_w, p_w, C]
+        x = x.permute(0, 3, 1, 4, 2, 5)
+        # [B, n_h, p_h, n_w, p_w, C] -> [B, H, W, C] (single copy) -> [B, C, H, W] in channels_last
+        x = x.reshape(batch_size, num_patch_h * self.patch_h, num_patch_w * self.patch_w, channels)
+        x = x.permute(0, 3, 1, 2)
+        # channels_last keeps interpolate on its NHWC kernel, which is much faster for few channels
         if info_dict["interpolate"]:
             x = F.interpolate(
                 x,
@@ -301,6 +332,11 @@ class MobileViTBlock(nn.Module):
             )
         return x
 
+    def _run_transformer(self, patches: Tensor) -> Tensor:
+        for transformer_layer in self.global_rep:
+            patches = transformer_layer(patches)
+        return self.global_ln(patches)
+
     def forward(self, x: Tensor) -> Tensor:
         res = x
 
@@ -310,46 +346,87 @@ class MobileViTBlock(nn.Module):
         patches, info_dict = self.unfolding(fm)
 
         # learn global representations
-        for transformer_layer in self.global_rep:
-            patches = transformer_layer(patches)
+        patches = self._run_transformer(patches)
 
         # [B x Patch x Patches x C] -> [B x C x Patches x Patch]
         fm = self.folding(x=patches, info_dict=info_dict)
 
         fm = self.conv_proj(fm)
 
-        fm = self.fusion(torch.cat((res, fm), dim=1))
+        # conv(cat(res, fm)) == conv_res(res) + conv_fm(fm), without materializing the 2C-channel concat
+        fm = self.fusion_norm_act(self.fusion(fm) + self.fusion_res(res))
         return fm
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints with a single fusion conv over cat(res, fm): split its weight by input channels
+        key = prefix + "fusion.block.conv.weight"
+        if key in state_dict and state_dict[key].shape[1] == 2 * self.cnn_in_dim:
+            weight_res, weight_fm = state_dict[key].chunk(2, dim=1)
+            state_dict[key] = weight_fm
+            state_dict[prefix + "fusion_res.block.conv.weight"] = weight_res
+        # checkpoints with the shared fusion norm stored inside the fusion ConvLayer
+        old_prefix = prefix + "fusion.block.norm."
+        for key in [k for k in state_dict if k.startswith(old_prefix)]:
+            state_dict[prefix + "fusion_norm_act.norm." + key[len(old_prefix):]] = state_dict.pop(key)
+        # checkpoints with the final LayerNorm stored as the last entry of global_rep
+        for name in ("weight", "bias"):
+            key = "{}global_rep.{}.{}".format(prefix, self.n_blocks, name)
+            if key in state_dict:
+                state_dict[prefix + "global_ln." + name] = state_dict.pop(key)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+
+# CUDA streams for the independent routes, created lazily per device. Kept out of module state since
+# streams cannot be pickled or deepcopied (torch.save, EMA copies, quantize_for_inference).
+_route_streams: Dict[torch.device, List[torch.cuda.Stream]] = {}
+
+
+def _get_route_streams(device: torch.device, num_streams: int) -> List[torch.cuda.Stream]:
+    streams = _route_streams.get(device, [])
+    if len(streams) < num_streams:
+        streams = streams + [torch.cuda.Stream(device=device) for _ in range(num_streams - len(streams))]
+        _route_streams[device] = streams
+    return streams[:num_streams]
+
 
 class GIFT_CIP(nn.Module):
 
-    def __init__(self, model_cfg: Dict,num_classes: int = 1000):
+    routes = ("a", "v", "az", "vz")
+    stem_layers = ("conv_1", "layer_1", "layer_2")
+
+    def __init__(self, model_cfg: Dict,num_classes: int = 1000,
+                 amp_dtype: Optional[torch.dtype] = torch.bfloat16, share_routes: bool = False):
         super().__init__()
 
         image_channels = 1
         out_channels = 16
 
-        #route 1
-        self.conv_1_a = ConvLayer(in_channels=image_channels, out_channels=out_channels, kernel_size=3, stride=2)
-        self.layer_1_a, out_channels_a = self._make_layer(input_channel=out_channels, cfg=model_cfg["layer1"])
-        self.layer_2_a, out_channels_a = self._make_layer(input_channel=out_channels_a, cfg=model_cfg["layer2"])
-        self.layer_3_a, out_channels_a = self._make_layer(input_channel=out_channels_a, cfg=model_cfg["layer3"])
-        #route 2
-        self.conv_1_v = ConvLayer(in_channels=image_channels, out_channels=out_channels, kernel_size=3, stride=2)
-        self.layer_1_v, out_channels_v = self._make_layer(input_channel=out_channels, cfg=model_cfg["layer1"])
-        self.layer_2_v, out_channels_v = self._make_layer(input_channel=out_channels_v, cfg=model_cfg["layer2"])
-        self.layer_3_v, out_channels_v = self._make_layer(input_channel=out_channels_v, cfg=model_cfg["layer3"])
-        #route 3
-        self.conv_1_az = ConvLayer(in_channels=image_channels, out_channels=out_channels, kernel_size=3, stride=2)
-        self.layer_1_az, out_channels_az = self._make_layer(input_channel=out_channels, cfg=model_cfg["layer1"])
-        self.layer_2_az, out_channels_az = self._make_layer(input_channel=out_channels_az, cfg=model_cfg["layer2"])
-        self.layer_3_az, out_channels_az = self._make_layer(input_channel=out_channels_az, cfg=model_cfg["layer3"])
-        #route 4
-        self.conv_1_vz = ConvLayer(in_channels=image_channels, out_channels=out_channels, kernel_size=3, stride=2)
-        self.layer_1_vz, out_channels_vz = self._make_layer(input_channel=out_channels, cfg=model_cfg["layer1"])
-        self.layer_2_vz, out_channels_vz = self._make_layer(input_channel=out_channels_vz, cfg=model_cfg["layer2"])
-        self.layer_3_vz, out_channels_vz = self._make_layer(input_channel=out_channels_vz, cfg=model_cfg["layer3"])
+        #route 1-4 stem: conv_1/layer_1/layer_2 of the four routes packed into one grouped stem (groups=4),
+        #or with share_routes a single stem (and layer_3) whose weights are shared by all four routes
+        num_routes = len(self.routes)
+        self.share_routes = share_routes
+        stem_groups = 1 if share_routes else num_routes
+        self.conv_1_stem = ConvLayer(in_channels=stem_groups * image_channels, out_channels=stem_groups * out_channels,
+                                     kernel_size=3, stride=2, groups=stem_groups)
+        self.layer_1_stem, out_channels_stem = self._make_layer(input_channel=stem_groups * out_channels,
+                                                                cfg=model_cfg["layer1"], groups=stem_groups)
+        self.layer_2_stem, out_channels_stem = self._make_layer(input_channel=out_channels_stem,
+                                                                cfg=model_cfg["layer2"], groups=stem_groups)
+        out_channels_stem //= stem_groups
+        if share_routes:
+            #route 1-4
+            self.layer_3_shared, out_channels_a = self._make_layer(input_channel=out_channels_stem,
+                                                                   cfg=model_cfg["layer3"])
+            out_channels_az = out_channels_a
+        else:
+            #route 1
+            self.layer_3_a, out_channels_a = self._make_layer(input_channel=out_channels_stem, cfg=model_cfg["layer3"])
+            #route 2
+            self.layer_3_v, out_channels_v = self._make_layer(input_channel=out_channels_stem, cfg=model_cfg["layer3"])
+            #route 3
+            self.layer_3_az, out_channels_az = self._make_layer(input_channel=out_channels_stem, cfg=model_cfg["layer3"])
+            #route 4
+            self.layer_3_vz, out_channels_vz = self._make_layer(input_channel=out_channels_stem, cfg=model_cfg["layer3"])
 
         #route 5
         self.layer_4_av, out_channels_av = self._make_layer(input_channel=out_channels_a, cfg=model_cfg["layer4"])
@@ -370,27 +447,36 @@ class GIFT_CIP(nn.Module):
         self.layer_avz.add_module(name="flatten", module=nn.Flatten())
         self.layer_avz.add_module(name="dropout", module=nn.Dropout(p=model_cfg["cls_dropout"]))
 
-        self.layer_cf_1 = nn.Linear(in_features=5, out_features=320)
-        self.layer_cf_2 = nn.Linear(in_features=320, out_features=160)
+        self.layer_cf = nn.Linear(in_features=5, out_features=160)
 
         self.linear1 = nn.Linear(1440, 2560)
         self.linear2 = nn.Linear(2560, 1280)
         self.linear3 = nn.Linear(1280, 640)
         self.last_linear4 = nn.Linear(in_features=640, out_features=num_classes)
 
+        # autocast dtype used on CUDA, None to run everything in FP32
+        self.amp_dtype = amp_dtype
+
         # weight init
         self.apply(self.init_parameters)
+        for stem_layer in self.stem_layers:
+            self.init_grouped_parameters(getattr(self, stem_layer + "_stem"), groups=stem_groups)
 
-    def _make_layer(self, input_channel, cfg: Dict) -> Tuple[nn.Sequential, int]:
+        # NHWC layout lets cuDNN pick its Tensor Core conv kernels
+        self.to(memory_format=torch.channels_last)
+
+    def _make_layer(self, input_channel, cfg: Dict, groups: int = 1) -> Tuple[nn.Sequential, int]:
         block_type = cfg.get("block_type", "mobilevit")
         if block_type.lower() == "mobilevit":
+            if groups != 1:
+                raise ValueError("Grouped layers are only supported for mv2 blocks. Got block_type={}".format(block_type))
             return self._make_mit_layer(input_channel=input_channel, cfg=cfg)
         else:
-            return self._make_mobilenet_layer(input_channel=input_channel, cfg=cfg)
+            return self._make_mobilenet_layer(input_channel=input_channel, cfg=cfg, groups=groups)
 
     @staticmethod
-    def _make_mobilenet_layer(input_channel: int, cfg: Dict) -> Tuple[nn.Sequential, int]:
-        output_channels = cfg.get("out_channels")
+    def _make_mobilenet_layer(input_channel: int, cfg: Dict, groups: int = 1) -> Tuple[nn.Sequential, int]:
+        output_channels = cfg.get("out_channels") * groups
         num_blocks = cfg.get("num_blocks", 2)
         expand_ratio = cfg.get("expand_ratio", 4)
         block = []
@@ -402,7 +488,8 @@ class GIFT_CIP(nn.Module):
                 in_channels=input_channel,
                 out_channels=output_channels,
                 stride=stride,
-                expand_ratio=expand_ratio
+                expand_ratio=expand_ratio,
+                groups=groups
             )
             block.append(layer)
             input_channel = output_channels
@@ -470,30 +557,130 @@ class GIFT_CIP(nn.Module):
         else:
             pass
 
-    def forward(self, a: Tensor, v: Tensor, az: Tensor,vz: Tensor,cf: Tensor) -> Tensor: #a动脉期瘤内，v静脉期瘤内，az动脉期瘤周，vz静脉期瘤周，cf临床特征
-        #route 1
-        a = self.conv_1_a(a)
-        a = self.layer_1_a(a)
-        a = self.layer_2_a(a)
-        a = self.layer_3_a(a)
-        # route 2
-        v = self.conv_1_v(v)
-        v = self.layer_1_v(v)
-        v = self.layer_2_v(v)
-        v = self.layer_3_v(v)
-        # route 3
-        az = self.conv_1_az(az)
-        az = self.layer_1_az(az)
-        az = self.layer_2_az(az)
-        az = self.layer_3_az(az)
-        # route 4
-        vz = self.conv_1_vz(vz)
-        vz = self.layer_1_vz(vz)
-        vz = self.layer_2_vz(vz)
-        vz = self.layer_3_vz(vz)
-        #融和
-        av = 0.5 * a + 0.5 * v
-        avz = 0.5 * az + 0.5 * vz
+    @staticmethod
+    def init_grouped_parameters(module: nn.Module, groups: int) -> None:
+        # re-init each group of a packed conv as if it were a standalone conv, so fan_out matches the unpacked routes
+        for m in module.modules():
+            if isinstance(m, nn.Conv2d):
+                for weight in m.weight.data.chunk(groups, dim=0):
+                    nn.init.kaiming_normal_(weight, mode="fan_out")
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints with separate conv_1/layer_1/layer_2 per route: stack them into the grouped stem
+        for stem_layer in (() if self.share_routes else self.stem_layers):
+            old_prefix = "{}{}_{}.".format(prefix, stem_layer, self.routes[0])
+            for key in [k for k in state_dict if k.startswith(old_prefix)]:
+                suffix = key[len(old_prefix):]
+                values = [state_dict.pop("{}{}_{}.{}".format(prefix, stem_layer, route, suffix)) for route in self.routes]
+                new_key = "{}{}_stem.{}".format(prefix, stem_layer, suffix)
+                state_dict[new_key] = torch.cat(values, dim=0) if values[0].dim() > 0 else values[0]
+        # checkpoints with the two-layer clinical-feature branch (5->320->160, no activation): fold into layer_cf
+        if prefix + "layer_cf_1.weight" in state_dict:
+            w1, b1 = state_dict.pop(prefix + "layer_cf_1.weight"), state_dict.pop(prefix + "layer_cf_1.bias")
+            w2, b2 = state_dict.pop(prefix + "layer_cf_2.weight"), state_dict.pop(prefix + "layer_cf_2.bias")
+            state_dict[prefix + "layer_cf.weight"] = w2 @ w1
+            state_dict[prefix + "layer_cf.bias"] = b2 + w2 @ b1
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def fuse_head(self) -> None:
+        # 分类头中linear1→linear2、linear3→last_linear4之间没有激活函数，各自合并为一个Linear（用于推理/导出）
+        if isinstance(self.linear2, nn.Linear):
+            self.linear1 = fuse_linear(self.linear1, self.linear2)
+            self.linear2 = nn.Identity()
+        if isinstance(self.linear3, nn.Linear):
+            self.last_linear4 = fuse_linear(self.linear3, self.last_linear4)
+            self.linear3 = nn.Identity()
+
+    @torch.no_grad()
+    def fuse_for_inference(self) -> "GIFT_CIP":
+        # 推理前调用：BN折叠进前面的卷积（每个ConvLayer只剩conv+act），并合并分类头
+        self.eval()
+        for module in list(self.modules()):
+            if isinstance(module, MobileViTBlock) and isinstance(module.fusion_norm_act.norm, nn.BatchNorm2d):
+                # fusion norm follows fusion(fm) + fusion_res(res): fold it into fusion, give fusion_res the same scale
+                norm = module.fusion_norm_act.norm
+                scale = norm.weight / torch.sqrt(norm.running_var + norm.eps)
+                module.fusion_res.block.conv.weight.mul_(scale.reshape(-1, 1, 1, 1))
+                module.fusion.block.conv = fuse_conv_bn_eval(module.fusion.block.conv, norm)
+                module.fusion_norm_act.norm = nn.Identity()
+        for module in list(self.modules()):
+            if isinstance(module, ConvLayer) and isinstance(getattr(module.block, "norm", None), nn.BatchNorm2d):
+                module.block.conv = fuse_conv_bn_eval(module.block.conv, module.block.norm)
+                module.block.norm = nn.Identity()
+        self.fuse_head()
+        return self
+
+    def _forward_routes(self, routes) -> Tuple[Tensor, ...]:
+        if not routes[0][0].is_cuda or torch.compiler.is_compiling():
+            outputs = []
+            for x, layers in routes:
+                for layer in layers:
+                    x = layer(x)
+                outputs.append(x)
+            return tuple(outputs)
+
+        # 四路之间互不依赖，各自放在独立的CUDA stream上并发执行，融和前再同步
+        device = routes[0][0].device
+        route_streams = _get_route_streams(device, len(routes))
+
+        current_stream = torch.cuda.current_stream(device)
+        outputs = []
+        for stream, (x, layers) in zip(route_streams, routes):
+            stream.wait_stream(current_stream)
+            with torch.cuda.stream(stream):
+                for layer in layers:
+                    x = layer(x)
+            outputs.append(x)
+
+        for stream, x in zip(route_streams, outputs):
+            current_stream.wait_stream(stream)
+            x.record_stream(current_stream)
+        return tuple(outputs)
+
+    @staticmethod
+    def pack_inputs(a: Tensor, v: Tensor, az: Tensor, vz: Tensor) -> Tensor:
+        # 4 x [..., H, W] -> [..., 4, H, W]；建议在Dataset.__getitem__中打包，配合pin_memory与non_blocking一次拷贝到GPU
+        return torch.stack((a.squeeze(-3), v.squeeze(-3), az.squeeze(-3), vz.squeeze(-3)), dim=-3)
+
+    def forward(self, x: Tensor, cf: Tensor) -> Tensor: #x: [B, 4, H, W]，通道依次为a动脉期瘤内，v静脉期瘤内，az动脉期瘤周，vz静脉期瘤周；cf临床特征
+        # conv/attention在CUDA上以autocast低精度计算，最后的分类层保持FP32
+        if x.is_cuda and self.amp_dtype is not None:
+            # every weight is cast once per forward, so the autocast cache buys nothing and would break CUDA graph capture
+            with torch.autocast(device_type=x.device.type, dtype=self.amp_dtype, cache_enabled=False):
+                output = self._forward_features(x, cf)
+        else:
+            # 不进入autocast上下文，torch.export得到的是普通aten图（PT2E量化需要）
+            output = self._forward_features(x, cf)
+        last_output = self.last_linear4(output.float())
+        return last_output
+
+    def _forward_features(self, x: Tensor, cf: Tensor) -> Tensor:
+        batch_size, num_routes, h, w = x.shape
+        if self.share_routes:
+            #route 1-4 共享权重: [B, 4, H, W] -> [4B, 1, H, W] -> shared stem + layer_3 -> [B, C, h, w] x 4
+            x = x.reshape(batch_size * num_routes, 1, h, w).contiguous(memory_format=torch.channels_last)
+            x = self.conv_1_stem(x)
+            x = self.layer_1_stem(x)
+            x = self.layer_2_stem(x)
+            x = self.layer_3_shared(x)
+            a, v, az, vz = x.view(batch_size, num_routes, *x.shape[1:]).unbind(1)
+        else:
+            #route 1-4 stem: [B, 4, H, W] -> grouped stem -> [B, 4C, h, w] -> [B, C, h, w] x 4
+            x = x.contiguous(memory_format=torch.channels_last)
+            x = self.conv_1_stem(x)
+            x = self.layer_1_stem(x)
+            x = self.layer_2_stem(x)
+            a, v, az, vz = x.chunk(len(self.routes), dim=1)
+
+            a, v, az, vz = self._forward_routes((
+                (a, (self.layer_3_a,)),  # route 1
+                (v, (self.layer_3_v,)),  # route 2
+                (az, (self.layer_3_az,)),  # route 3
+                (vz, (self.layer_3_vz,)),  # route 4
+            ))
+        #融和: lerp(x, y, 0.5) == 0.5 * x + 0.5 * y in a single kernel
+        av = torch.lerp(a, v, 0.5)
+        avz = torch.lerp(az, vz, 0.5)
         # route 5
         av = self.layer_4_av(av)
         av = self.layer_5_av(av)
@@ -505,8 +692,7 @@ class GIFT_CIP(nn.Module):
         avz = self.conv_1x1_exp_avz(avz)
         avz = self.layer_avz(avz)
         #临床特征
-        cf = self.layer_cf_1(cf)
-        cf = self.layer_cf_2(cf)
+        cf = self.layer_cf(cf)
 
         # av_avz = 0.5*av + 0.5*avz
 
@@ -517,12 +703,102 @@ class GIFT_CIP(nn.Module):
         # output = torch.relu(output)
         output = self.linear3(output)
         # output = torch.relu(output)
-        last_output = self.last_linear4(output)
-        return last_output
+        return output
+
+
+# compiled (unbound) forward per block class, shared by all instances of that class
+_compiled_forwards: Dict[type, Callable] = {}
 
 
-def GIFT_CIP_(num_classes: int = 1000):
+def _compiled_block_forward(self: nn.Module, x: Tensor, *args, **kwargs) -> Tensor:
+    # 通道数、patch大小、特征图H,W保持静态，只把batch维标记为动态，避免最后一个不完整batch触发重新编译
+    torch._dynamo.maybe_mark_dynamic(x, 0)
+    return _compiled_forwards[type(self)](self, x, *args, **kwargs)
+
+
+def _compile_block(block: nn.Module) -> None:
+    block_type = type(block)
+    if block_type not in _compiled_forwards:
+        _compiled_forwards[block_type] = torch.compile(block_type.forward, dynamic=False, fullgraph=True)
+    # bound method rather than a closure: deepcopy rebinds it to the copied block
+    block.forward = types.MethodType(_compiled_block_forward, block)
+
+
+def GIFT_CIP_(num_classes: int = 1000, compile: Optional[str] = None, share_routes: bool = False,
+              cudnn_benchmark: bool = False):
     config = get_config("small")
-    m = GIFT_CIP(config, num_classes=num_classes)
+    m = GIFT_CIP(config, num_classes=num_classes, share_routes=share_routes)
+    if cudnn_benchmark:
+        # 全局设置，仅在输入尺寸固定时开启：让cuDNN为channels_last卷积挑选最快的kernel（尺寸可变时每个新尺寸都会重新搜索）
+        torch.backends.cudnn.benchmark = True
+    if compile is None:
+        return m
+
+    # 编译路径下剩余的FP32 matmul使用TF32
+    torch.set_float32_matmul_precision("high")
+    if compile == "full":
+        # 整图编译：输入的H,W及batch需保持固定，否则会触发重新编译；推理前请先调用m.eval()
+        m = torch.compile(m, mode="reduce-overhead", fullgraph=True, backend="inductor")
+    elif compile == "regional":
+        # 分区编译：同类模块共用一个forward代码对象，结构相同的模块复用编译结果，编译时间远小于整图编译
+        # 每种模块结构/特征图尺寸 × train/eval 各占一个缓存项，按实例数放宽重编译上限
+        blocks = [module for module in m.modules() if isinstance(module, (InvertedResidual, MobileViTBlock))]
+        max_entries = 4 * max(sum(isinstance(block, cls) for block in blocks) for cls in (InvertedResidual, MobileViTBlock))
+        torch._dynamo.config.recompile_limit = max(torch._dynamo.config.recompile_limit, max_entries)
+        for block in blocks:
+            _compile_block(block)
+    else:
+        raise ValueError("compile should be one of None, 'full' or 'regional'. Got: {}".format(compile))
     return m
 
+
+def capture_cuda_graph(m: nn.Module, *sample_inputs: Tensor, num_warmup: int = 3):
+    # 推理输入的形状/dtype/device固定时，把整个前向录制成一张CUDA Graph，之后每次调用只拷贝输入并replay，几乎没有kernel launch开销
+    # 返回的输出张量在下一次调用时会被覆盖，需要保留时请clone
+    m.eval()
+    static_inputs = [x.clone() for x in sample_inputs]
+
+    # 预热需在非默认stream上进行（同时创建各路的CUDA stream、完成cuDNN benchmark）
+    warmup_stream = torch.cuda.Stream()
+    warmup_stream.wait_stream(torch.cuda.current_stream())
+    with torch.cuda.stream(warmup_stream), torch.no_grad():
+        for _ in range(num_warmup):
+            m(*static_inputs)
+    torch.cuda.current_stream().wait_stream(warmup_stream)
+
+    graph = torch.cuda.CUDAGraph()
+    with torch.cuda.graph(graph), torch.no_grad():
+        static_output = m(*static_inputs)
+
+    def replay(*inputs: Tensor) -> Tensor:
+        for static_input, x in zip(static_inputs, inputs):
+            static_input.copy_(x, non_blocking=True)
+        graph.replay()
+        return static_output
+
+    return replay
+
+
+def quantize_for_inference(m: GIFT_CIP, calibration_data: Iterable[Tuple[Tensor, Tensor]]) -> nn.Module:
+    # INT8静态训练后量化（PT2E，依赖torchao）：torch.export导出整图后由X86InductorQuantizer为Conv(+BN+SiLU)与Linear插入量化节点，
+    # 函数式的cat/lerp/残差相加无需改写；calibration_data为若干(x, cf)批次（如验证集DataLoader），用于统计激活范围
+    # 返回量化后的GraphModule（原模型不变），需再经torch.compile才会生成INT8 kernel
+    from torchao.quantization.pt2e.quantize_pt2e import convert_pt2e, prepare_pt2e
+    from torchao.quantization.pt2e.quantizer.x86_inductor_quantizer import (
+        X86InductorQuantizer,
+        get_default_x86_inductor_quantization_config,
+    )
+
+    m = copy.deepcopy(m).eval()
+    batches = iter(calibration_data)
+    example_inputs = tuple(next(batches))
+    batch = torch.export.Dim("batch")
+    with torch.no_grad():
+        exported = torch.export.export(m, example_inputs, dynamic_shapes=({0: batch}, {0: batch})).module()
+
+        quantizer = X86InductorQuantizer().set_global(get_default_x86_inductor_quantization_config())
+        prepared = prepare_pt2e(exported, quantizer)
+        prepared(*example_inputs)
+        for x, cf in batches:
+            prepared(x, cf)
+        return convert_pt2e(prepared)
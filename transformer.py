@@ -1,8 +1,8 @@
 from typing import Optional
 
-import torch
 import torch.nn as nn
 from torch import Tensor
+from torch.nn import functional as F
 
 
 class MultiHeadAttention(nn.Module):
@@ -31,7 +31,6 @@ class MultiHeadAttention(nn.Module):
 
         self.head_dim = embed_dim // num_heads
         self.scaling = self.head_dim ** -0.5
-        self.softmax = nn.Softmax(dim=-1)
         self.num_heads = num_heads
         self.embed_dim = embed_dim
 
@@ -43,26 +42,18 @@ class MultiHeadAttention(nn.Module):
         # [N, P, C] -> [N, P, 3C] -> [N, P, 3, h, c] where C = hc
         qkv = self.qkv_proj(x_q).reshape(b_sz, n_patches, 3, self.num_heads, -1)
 
-        # [N, P, 3, h, c] -> [N, h, 3, P, C]
-        qkv = qkv.transpose(1, 3).contiguous()
-
-        # [N, h, 3, P, C] -> [N, h, P, C] x 3
-        query, key, value = qkv[:, :, 0], qkv[:, :, 1], qkv[:, :, 2]
-
-        query = query * self.scaling
-
-        # [N h, P, c] -> [N, h, c, P]
-        key = key.transpose(-1, -2)
-
-        # QK^T
-        # [N, h, P, c] x [N, h, c, P] -> [N, h, P, P]
-        attn = torch.matmul(query, key)
-        attn = self.softmax(attn)
-        attn = self.attn_dropout(attn)
-
-        # weighted sum
-        # [N, h, P, P] x [N, h, P, c] -> [N, h, P, c]
-        out = torch.matmul(attn, value)
+        # [N, P, 3, h, c] -> [3, N, h, P, c] -> [N, h, P, c] x 3
+        query, key, value = qkv.permute(2, 0, 3, 1, 4).unbind(0)
+
+        # softmax(QK^T * scaling) V in one fused kernel (FlashAttention / memory-efficient attention on CUDA)
+        # [N, h, P, c] -> [N, h, P, c]
+        out = F.scaled_dot_product_attention(
+            query,
+            key,
+            value,
+            dropout_p=self.attn_dropout.p if self.training else 0.0,
+            scale=self.scaling,
+        )
 
         # [N, h, P, c] -> [N, P, h, c] -> [N, P, C]
         out = out.transpose(1, 2).reshape(b_sz, n_patches, -1)